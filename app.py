@@ -1,33 +1,80 @@
 ﻿
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field, conint
-from typing import List, Tuple, Literal, Iterable, Set
+from typing import List, Tuple, Literal
+from collections import OrderedDict
+import asyncio
+import threading
 import math
+import numpy as np
 import h3
+import h3.api.numpy_int as h3i  # células uint64 nos caminhos internos
 
-app = FastAPI(title="H3 Service", version="0.3.0")
+try:
+    from numba import njit
+except Exception:  # sem numba o kernel roda igual, só que em Python puro
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+try:
+    import cupy as cp  # opcional: PNP em GPU p/ polyfills grandes
+except Exception:
+    cp = None
 
+app = FastAPI(title="H3 Service", version="0.3.0")
 
-def _latlng_to_cell(lat: float, lng: float, res: int) -> str:
-    if hasattr(h3, "latlng_to_cell"):      # v4
-        return h3.latlng_to_cell(lat, lng, res)
-    if hasattr(h3, "geo_to_h3"):           # v3
-        return h3.geo_to_h3(lat, lng, res)
-    raise RuntimeError("H3: função de index não encontrada (v3/v4).")
 
-def _cell_to_boundary(cell: str) -> List[Tuple[float, float]]:
-    if hasattr(h3, "cell_to_boundary"):    # v4
-        return h3.cell_to_boundary(cell)
-    if hasattr(h3, "h3_to_geo_boundary"):  # v3
-        return h3.h3_to_geo_boundary(cell)
-    raise RuntimeError("H3: função de boundary não encontrada (v3/v4).")
+def _bind_h3(v4: str, v3: str, what: str, api=h3):
+    """Resolve uma vez, no import, a função H3 (v4 -> v3); some o hasattr por chamada."""
+    fn = getattr(api, v4, None) or getattr(api, v3, None)
+    if fn is not None:
+        return fn
+    def _missing(*args, **kwargs):
+        raise RuntimeError(f"H3: função de {what} não encontrada (v3/v4).")
+    return _missing
+
+_HAS_V4 = hasattr(h3, "latlng_to_cell")
+
+# referências diretas às funções C do binding
+_latlng_to_cell = _bind_h3("latlng_to_cell", "geo_to_h3", "index")
+_cell_to_boundary = _bind_h3("cell_to_boundary", "h3_to_geo_boundary", "boundary")
+_GRID_DISK = _bind_h3("grid_disk", "k_ring", "vizinhança")
+_EDGE_LENGTH = _bind_h3("average_hexagon_edge_length", "edge_length", "aresta média")
+_int_to_str = _bind_h3("int_to_str", "h3_to_string", "conversão int->str")
+
+# API inteira (uint64): sem objeto str por célula; a string só aparece na resposta HTTP
+_latlng_to_int = _bind_h3("latlng_to_cell", "geo_to_h3", "index", api=h3i)
+_int_to_latlng = _bind_h3("cell_to_latlng", "h3_to_geo", "centróide", api=h3i)
+_GRID_DISK_INT = _bind_h3("grid_disk", "k_ring", "vizinhança", api=h3i)
+_CHILDREN_INT = _bind_h3("cell_to_children", "h3_to_children", "filhos", api=h3i)
+
+# polyfill nativo: v4 (>= 4.1 experimental c/ containment), v4 polygon_to_cells, v3 polyfill
+_POLYGON_TO_CELLS_EXP = getattr(h3, "polygon_to_cells_experimental", None)
+_POLYGON_TO_CELLS = getattr(h3, "polygon_to_cells", None)
+_POLYFILL_V3 = getattr(h3, "polyfill", None)
+
+# ?mode= do /h3/polyfill -> containment do polygon_to_cells_experimental
+PolyfillMode = Literal["centroid", "contains", "intersects", "covers"]
+_CONTAINMENT = {
+    "centroid": "center",        # centróide dentro (semântica do polygon_to_cells)
+    "contains": "full",          # célula inteira dentro
+    "intersects": "overlap",     # célula toca o polígono
+    "covers": "bbox_overlap",    # bbox da célula toca o polígono (cobertura garantida)
+}
+
+def _parse_cell(cell: str) -> str:
+    # aceita o id em hex (15 chars) ou em decimal (uint64 como nos parquets, 18+ dígitos;
+    # hex só com dígitos também existe, daí o corte pelo tamanho)
+    return _int_to_str(int(cell)) if len(cell) > 15 and cell.isdigit() else cell
 
 def _grid_disk(cell: str, k: int) -> List[str]:
-    if hasattr(h3, "grid_disk"):           # v4
-        return list(h3.grid_disk(cell, k))
-    if hasattr(h3, "k_ring"):              # v3
-        return list(h3.k_ring(cell, k))
-    raise RuntimeError("H3: função de vizinhança não encontrada (v3/v4).")
+    # v3 devolve set
+    return list(_GRID_DISK(cell, k))
+
+def _edge_length_km(res: int) -> float:
+    return _EDGE_LENGTH(res, unit="km")
 
 
 class GeoJSONPolygon(BaseModel):
@@ -43,15 +90,15 @@ class PolyfillRequest(BaseModel):
 
 
 @app.get("/healthz")
-def health():
+async def health():
     return {
         "status": "ok",
         "h3_version": getattr(h3, "__version__", "unknown"),
-        "has_v4": hasattr(h3, "latlng_to_cell") and hasattr(h3, "cell_to_boundary"),
+        "has_v4": _HAS_V4 and hasattr(h3, "cell_to_boundary"),
     }
 
 @app.get("/h3/index")
-def latlng_to_h3(lat: float, lng: float, res: int = 9):
+async def latlng_to_h3(lat: float, lng: float, res: int = 9):
     if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
         raise HTTPException(400, "lat/lng fora dos limites")
     if res < 0 or res > 15:
@@ -62,46 +109,173 @@ def latlng_to_h3(lat: float, lng: float, res: int = 9):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/h3/boundary/{cell}")
-def cell_boundary(cell: str):
+async def cell_boundary(cell: str):
     try:
-        return {"boundary": _cell_to_boundary(cell)}
+        return {"boundary": _cell_to_boundary(_parse_cell(cell))}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/h3/kring")
-def kring(cell: str, k: conint(ge=0, le=10) = 1):
+async def kring(cell: str, k: conint(ge=0, le=10) = 1):
     try:
-        neighbors = _grid_disk(cell, k)
+        neighbors = _grid_disk(_parse_cell(cell), k)
         return {"cells": neighbors}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-def _normalize_ring_lnglat(ring: List[List[float]]) -> List[List[float]]:
+def _normalize_ring_lnglat(ring: np.ndarray) -> np.ndarray:
     # Remove duplicação de primeiro/último ponto 
-    if len(ring) >= 2 and ring[0] == ring[-1]:
+    if len(ring) >= 2 and np.array_equal(ring[0], ring[-1]):
         return ring[:-1]
     return ring
 
-def _bbox(ring: List[List[float]]) -> Tuple[float, float, float, float]:
-    lngs = [p[0] for p in ring]
-    lats = [p[1] for p in ring]
-    return min(lngs), min(lats), max(lngs), max(lats)
-
-def _point_in_poly(lng: float, lat: float, ring: List[List[float]]) -> bool:
-    # array (lng,lat) com anel aberto
-    inside = False
-    n = len(ring)
-    for i in range(n):
-        x1, y1 = ring[i]
-        x2, y2 = ring[(i + 1) % n]
-        # checa se cruza a aresta
-        cond = ((y1 > lat) != (y2 > lat))
-        if cond:
-            xin = (x2 - x1) * (lat - y1) / (y2 - y1 + 1e-15) + x1
-            if xin > lng:
-                inside = not inside
-    return inside
+def _ring_array(ring: List[List[float]]) -> np.ndarray:
+    """Anel GeoJSON -> array float64 (N,2) [lng,lat], aberto. Feito uma vez por request."""
+    try:
+        arr = np.asarray(ring, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError("coordenadas do anel devem ser pares [lng,lat]")
+    if arr.ndim != 2 or arr.shape[1] < 2:
+        raise ValueError("coordenadas do anel devem ser pares [lng,lat]")
+    if not np.isfinite(arr[:, :2]).all():
+        raise ValueError("coordenadas do anel devem ser finitas")
+    return _normalize_ring_lnglat(np.ascontiguousarray(arr[:, :2]))
+
+def _bbox(ring: np.ndarray) -> Tuple[float, float, float, float]:
+    minx, miny = ring.min(0)
+    maxx, maxy = ring.max(0)
+    return float(minx), float(miny), float(maxx), float(maxy)
+
+# nº máx. de faixas de latitude do índice de arestas
+_EDGE_SLABS_MAX = 4096
+
+def _edge_index(rx: np.ndarray, ry: np.ndarray) -> Tuple[np.ndarray, float, float, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pré-processa o anel uma vez por polígono p/ o _pnpoly_mask:
+    - bbox (minx, miny, maxx, maxy) p/ rejeitar pontos de fora logo de cara;
+    - tabela de arestas (x1, y1, y2, dx/dy): a aresta i liga os vértices i e i-1,
+      inclinação pré-calculada (xin = slope*(y - y1) + x1, uma FMA);
+    - índice por faixas de latitude (CSR): as arestas que tocam a faixa s são
+      idx[ptr[s]:ptr[s+1]]; só elas podem cruzar um raio horizontal naquela faixa.
+    Retorna (bbox, y0, 1/altura_da_faixa, ptr, idx, tabela).
+    """
+    n = rx.shape[0]
+    bbox = np.array([rx.min(), ry.min(), rx.max(), ry.max()], dtype=np.float64)
+    y0 = float(bbox[1])
+    nslab = max(1, min(n, _EDGE_SLABS_MAX))
+    height = float(bbox[3]) - y0
+    inv_h = nslab / height if height > 0 else 0.0
+
+    prev_x, prev_y = np.roll(rx, 1), np.roll(ry, 1)  # vértice j = i-1 (o anel é aberto)
+    dy = prev_y - ry
+    slope = np.divide(prev_x - rx, dy, out=np.zeros(n), where=dy != 0)  # horizontais nunca cruzam
+    table = np.ascontiguousarray(np.column_stack((rx, ry, prev_y, slope)))
+
+    s0 = np.minimum(((np.minimum(ry, prev_y) - y0) * inv_h).astype(np.int64), nslab - 1)
+    s1 = np.minimum(((np.maximum(ry, prev_y) - y0) * inv_h).astype(np.int64), nslab - 1)
+    lens = s1 - s0 + 1
+    starts = np.cumsum(lens) - lens
+    slab = np.repeat(s0, lens) + (np.arange(int(lens.sum())) - np.repeat(starts, lens))
+    order = np.argsort(slab, kind="stable")
+    idx = np.repeat(np.arange(n, dtype=np.int64), lens)[order]
+    ptr = np.zeros(nslab + 1, dtype=np.int64)
+    np.cumsum(np.bincount(slab, minlength=nslab), out=ptr[1:])
+    return bbox, y0, inv_h, ptr, idx, table
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def _pnpoly_mask(px, py, bbox, y0, inv_h, ptr, idx, table):
+    """
+    PNPOLY (W. R. Franklin): ray-casting de cada ponto (px[k], py[k]) contra o
+    anel pré-processado por _edge_index (lng, lat). Retorna máscara booleana dos
+    pontos dentro. Fora do bbox rejeita direto; dentro, só percorre as arestas
+    da faixa de latitude do ponto.
+    """
+    nslab = ptr.shape[0] - 1
+    minx, miny, maxx, maxy = bbox[0], bbox[1], bbox[2], bbox[3]
+    out = np.zeros(px.shape[0], dtype=np.bool_)
+    for k in range(px.shape[0]):
+        x = px[k]
+        y = py[k]
+        if not (minx <= x <= maxx and miny <= y <= maxy):
+            continue
+        s = min(int((y - y0) * inv_h), nslab - 1)
+        inside = False
+        for e in range(ptr[s], ptr[s + 1]):
+            i = idx[e]
+            y1 = table[i, 1]
+            # cruza a aresta? a condição garante y1 != y2
+            if (y1 > y) != (table[i, 2] > y):
+                if x < table[i, 3] * (y - y1) + table[i, 0]:
+                    inside = not inside
+        out[k] = inside
+    return out
+
+# aquece o JIT no import (triângulo dummy) p/ não pagar compilação no 1º request
+_pnpoly_mask(np.array([0.25]), np.array([0.25]),
+             *_edge_index(np.array([0.0, 1.0, 0.0]), np.array([0.0, 0.0, 1.0])))
+
+# acima disso (e com cupy + GPU) o PNP roda na GPU
+_GPU_MIN_POINTS = 200_000
+_GPU_BLOCK = 256
+
+_PNPOLY_CUDA_SRC = r"""
+extern "C" __global__
+void pnpoly(const double* rx, const double* ry, const int n,
+            const double* px, const double* py, const long long m,
+            unsigned char* out)
+{
+    // vértices do anel lidos em blocos p/ memória compartilhada
+    extern __shared__ double sh[];
+    double* sx = sh;
+    double* sy = sh + blockDim.x;
+    const long long k = (long long)blockIdx.x * blockDim.x + threadIdx.x;
+    double x = 0.0, y = 0.0;
+    if (k < m) { x = px[k]; y = py[k]; }
+    bool inside = false;
+    for (int base = 0; base < n; base += blockDim.x) {
+        const int t = base + threadIdx.x;
+        if (t < n) { sx[threadIdx.x] = rx[t]; sy[threadIdx.x] = ry[t]; }
+        __syncthreads();
+        const int cnt = min((int)blockDim.x, n - base);
+        for (int q = 0; q < cnt; ++q) {
+            const int i = base + q;
+            const int j = (i == 0) ? n - 1 : i - 1;
+            const double xi = sx[q], yi = sy[q];
+            const double xj = (q > 0) ? sx[q - 1] : rx[j];
+            const double yj = (q > 0) ? sy[q - 1] : ry[j];
+            if (((yi > y) != (yj > y)) && (x < (xj - xi) * (y - yi) / (yj - yi) + xi))
+                inside = !inside;
+        }
+        __syncthreads();
+    }
+    if (k < m) out[k] = inside ? 1 : 0;
+}
+"""
+
+_pnpoly_cuda = cp.RawKernel(_PNPOLY_CUDA_SRC, "pnpoly") if cp is not None else None
+
+def _pnpoly_mask_gpu(rx: np.ndarray, ry: np.ndarray, px: np.ndarray, py: np.ndarray) -> np.ndarray:
+    """PNPOLY na GPU, uma thread por ponto; volta p/ o host só o índice dos pontos dentro."""
+    m = px.shape[0]
+    d_out = cp.zeros(m, dtype=cp.uint8)
+    grid = ((m + _GPU_BLOCK - 1) // _GPU_BLOCK,)
+    _pnpoly_cuda(grid, (_GPU_BLOCK,),
+                 (cp.asarray(rx), cp.asarray(ry), np.int32(rx.shape[0]),
+                  cp.asarray(px), cp.asarray(py), np.int64(m), d_out),
+                 shared_mem=2 * _GPU_BLOCK * 8)
+    mask = np.zeros(m, dtype=np.bool_)
+    mask[cp.asnumpy(cp.flatnonzero(d_out))] = True
+    return mask
+
+def _pip_mask(rx: np.ndarray, ry: np.ndarray, px: np.ndarray, py: np.ndarray, edges: Tuple) -> np.ndarray:
+    """PNP dos pontos: GPU p/ lotes grandes quando disponível, senão kernel numba indexado."""
+    if _pnpoly_cuda is not None and px.shape[0] > _GPU_MIN_POINTS:
+        try:
+            return _pnpoly_mask_gpu(rx, ry, px, py)
+        except Exception:
+            pass  # cupy sem device/driver utilizável: segue na CPU
+    return _pnpoly_mask(px, py, *edges)
 
 def _estimate_deg_step(res: int, lat_mid: float, max_pts: int, w: float, h: float) -> Tuple[float, float, int, int]:
     """
@@ -122,85 +296,209 @@ def _estimate_deg_step(res: int, lat_mid: float, max_pts: int, w: float, h: floa
     step_lat = h / ny if ny > 0 else h
     return step_lng, step_lat, nx, ny
 
-def _sample_polyfill(ring_lnglat: List[List[float]], res: int, max_pts: int = 2500) -> List[str]:
+# teto de células-filhas avaliadas pela cobertura grossa; acima disso, grade amostrada
+_COVER_MAX_CELLS = 1_000_000
+# acima disso o polyfill vai p/ uma thread e não segura o event loop
+_POLYFILL_THREAD_MIN_CELLS = 5_000
+_KM_PER_DEG = 111.32
+
+def _bbox_cell_estimate(bbox: Tuple[float, float, float, float], res: int) -> float:
+    """Estimativa grosseira de quantas células `res` cabem no bbox (lng/lat em graus)."""
+    minx, miny, maxx, maxy = bbox
+    coslat = max(math.cos(math.radians((miny + maxy) / 2.0)), 0.01)
+    area_km2 = (maxx - minx) * _KM_PER_DEG * coslat * (maxy - miny) * _KM_PER_DEG
+    # área do hexágono = 3*sqrt(3)/2 * aresta^2
+    edge = _edge_length_km(res)
+    return area_km2 / (2.598 * edge * edge)
+
+def _cover_polyfill(rx: np.ndarray, ry: np.ndarray, edges: Tuple, res: int,
+                    bbox: Tuple[float, float, float, float],
+                    max_cells: int = _COVER_MAX_CELLS):
+    """
+    Cobertura em 2 estágios: disco de células grossas (res-3) sobre o bbox,
+    expande p/ filhos em `res` e mantém os filhos cujo centróide passa no PNP.
+    Mesma semântica de centróide do polygon_to_cells. None se estourar max_cells.
     """
-    Fallback: varre um grid dentro do bbox, filtra por PNP e indexa com H3.
-    Retorna lista única de cells.
+    if _bbox_cell_estimate(bbox, res) > max_cells:
+        return None
+
+    minx, miny, maxx, maxy = bbox
+    lat_mid, lng_mid = (miny + maxy) / 2.0, (minx + maxx) / 2.0
+    coslat = max(math.cos(math.radians(lat_mid)), 0.01)
+    w_km = (maxx - minx) * _KM_PER_DEG * coslat
+    h_km = (maxy - miny) * _KM_PER_DEG
+
+    coarse_res = max(0, res - 3)
+    edge = _edge_length_km(coarse_res)
+    # raio do disco em células: meia diagonal / ~1.5 aresta (apótema do anel k), +1 de folga
+    k = int(math.ceil(0.5 * math.hypot(w_km, h_km) / (1.5 * edge))) + 1
+    coarse = np.asarray(_GRID_DISK_INT(_latlng_to_int(lat_mid, lng_mid, coarse_res), k), dtype=np.uint64)
+
+    # descarta células grossas cujo centróide está longe do bbox (> 2 arestas)
+    pad_lat = 2.0 * edge / _KM_PER_DEG
+    pad_lng = pad_lat / coslat
+    kept = []
+    for c in coarse.tolist():
+        lat, lng = _int_to_latlng(c)
+        if miny - pad_lat <= lat <= maxy + pad_lat and minx - pad_lng <= lng <= maxx + pad_lng:
+            kept.append(c)
+    if not kept:
+        return set()
+
+    children = np.concatenate([np.asarray(_CHILDREN_INT(c, res), dtype=np.uint64) for c in kept])
+    latlng = np.array([_int_to_latlng(ch) for ch in children.tolist()], dtype=np.float64)
+    inside = _pip_mask(rx, ry, np.ascontiguousarray(latlng[:, 1]), np.ascontiguousarray(latlng[:, 0]), edges)
+    # o id do filho já é a célula final: nada a reindexar, só vira str na saída
+    return {_int_to_str(c) for c in children[inside].tolist()}
+
+def _sample_polyfill(ring_lnglat: np.ndarray, res: int, max_pts: int = 2500) -> List[str]:
+    """
+    Fallback: cobertura grossa H3 + PNP nos centróides dos filhos; para bbox
+    grande demais, varre um grid dentro do bbox, filtra por PNP e indexa com H3.
+    `ring_lnglat` é o array (N,2) de _ring_array. Retorna lista única de cells.
     """
     ring = _normalize_ring_lnglat(ring_lnglat)
     minx, miny, maxx, maxy = _bbox(ring)
     w, h = maxx - minx, maxy - miny
     if w <= 0 or h <= 0:
         # Polígono degenerado  usa o primeiro ponto
-        lat, lng = ring[0][1], ring[0][0]
+        lng, lat = ring[0].tolist()
         return [ _latlng_to_cell(lat, lng, res) ]
 
-    lat_mid = (miny + maxy) / 2.0
-    step_lng, step_lat, nx, ny = _estimate_deg_step(res, lat_mid, max_pts, w, h)
-
-    cells: Set[str] = set()
-    # Varredura centro-dos-pixels (evita pegar borda)
-    for ix in range(nx):
-        lng = minx + (ix + 0.5) * step_lng
-        for iy in range(ny):
-            lat = miny + (iy + 0.5) * step_lat
-            if _point_in_poly(lng, lat, ring):
-                try:
-                    cells.add(_latlng_to_cell(lat, lng, res))
-                except Exception:
-                    # ignora pontos inválidos
-                    pass
+    rx, ry = np.ascontiguousarray(ring[:, 0]), np.ascontiguousarray(ring[:, 1])
+    edges = _edge_index(rx, ry)
+
+    cells = _cover_polyfill(rx, ry, edges, res, (minx, miny, maxx, maxy))
+    if cells is None:
+        lat_mid = (miny + maxy) / 2.0
+        step_lng, step_lat, nx, ny = _estimate_deg_step(res, lat_mid, max_pts, w, h)
+
+        # Varredura centro-dos-pixels (evita pegar borda), PNP vetorizado
+        xs, ys = np.meshgrid(minx + (np.arange(nx) + 0.5) * step_lng,
+                             miny + (np.arange(ny) + 0.5) * step_lat)
+        xs, ys = xs.ravel(), ys.ravel()
+        inside = _pip_mask(rx, ry, xs, ys, edges)
+
+        cells = set()
+        for lng, lat in zip(xs[inside].tolist(), ys[inside].tolist()):
+            try:
+                cells.add(_latlng_to_cell(lat, lng, res))
+            except Exception:
+                # ignora pontos inválidos
+                pass
 
     if not cells:
         # último recurso: pega o centróide aproximado (média) e indexa
-        cx = sum(p[0] for p in ring) / len(ring)
-        cy = sum(p[1] for p in ring) / len(ring)
+        cx, cy = ring.mean(0).tolist()
         cells.add(_latlng_to_cell(cy, cx, res))
     return list(cells)
 
 # ---------- polyfill (v4 -> v3 -> fallback) ----------
 def _polyfill_try_v4(geojson_polygon: dict, res: int) -> List[str]:
-    # v4: polygon_to_cells com GeoJSON
-    return list(h3.polygon_to_cells(geojson_polygon, res))  # type: ignore[attr-defined]
+    # v4: polygon_to_cells recebe H3Shape (não aceita o dict GeoJSON direto)
+    shape = h3.geo_to_h3shape(geojson_polygon)  # type: ignore[attr-defined]
+    return list(_POLYGON_TO_CELLS(shape, res))
+
+def _polyfill_try_v4_experimental(geojson_polygon: dict, res: int, mode: str) -> List[str]:
+    # v4 >= 4.1: containment explícito (mais rápido que o polygon_to_cells clássico)
+    shape = h3.geo_to_h3shape(geojson_polygon)  # type: ignore[attr-defined]
+    return list(_POLYGON_TO_CELLS_EXP(shape, res, contain=_CONTAINMENT[mode]))
 
 def _polyfill_try_v3(geojson_polygon: dict, res: int) -> List[str]:
     # v3: polyfill com GeoJSON
-    return list(h3.polyfill(geojson_polygon, res, geo_json_conformant=True))  # type: ignore[call-arg]
+    return list(_POLYFILL_V3(geojson_polygon, res, geo_json_conformant=True))
+
+def _polyfill_compute(ring_key: bytes, res: int, mode: str = "centroid") -> Tuple[str, ...]:
+    """
+    Polyfill de (anel, res, mode). `ring_key` são os bytes do array float64 (N,2)
+    [lng,lat] do anel externo aberto. Devolve tupla imutável.
+    Só o "centroid" tem v4 clássico/v3/fallback; os demais exigem o experimental.
+    """
+    ring = np.frombuffer(ring_key, dtype=np.float64).reshape(-1, 2)
+    ring_lnglat = ring.tolist()
+
+    # GeoJSON fechado para chamadas diretas
+    gj = {"type": "Polygon", "coordinates": [ring_lnglat + [ring_lnglat[0]]]}
+
+    if mode != "centroid":
+        return tuple(_polyfill_try_v4_experimental(gj, res, mode))
+
+    try:
+        if _POLYGON_TO_CELLS_EXP is not None:
+            cells = _polyfill_try_v4_experimental(gj, res, mode)
+        elif _POLYGON_TO_CELLS is not None:
+            cells = _polyfill_try_v4(gj, res)
+        elif _POLYFILL_V3 is not None:
+            cells = _polyfill_try_v3(gj, res)
+        else:
+            raise RuntimeError("Bindings H3 sem polygon_to_cells/polyfill.")
+    except Exception:
+        # fallback robusto
+        cells = _sample_polyfill(ring, res)
+    return tuple(cells)
+
+# cache LRU limitado pelo total de células guardadas, não só por entradas: um
+# polígono grande em res alta sozinho são milhões de ids
+_POLYFILL_CACHE_MAX_ENTRIES = 1024
+_POLYFILL_CACHE_MAX_CELLS = 2_000_000
+_POLYFILL_CACHE_ENTRY_MAX_CELLS = 200_000  # acima disso nem entra (recalcula sempre)
+_polyfill_cache: "OrderedDict[Tuple[bytes, int, str], Tuple[str, ...]]" = OrderedDict()
+_polyfill_cache_cells = 0
+_polyfill_cache_lock = threading.Lock()  # polyfill grande roda em asyncio.to_thread
+
+def _polyfill_cached(ring_key: bytes, res: int, mode: str = "centroid") -> Tuple[str, ...]:
+    """_polyfill_compute memoizado por (anel, res, mode)."""
+    global _polyfill_cache_cells
+    key = (ring_key, res, mode)
+    with _polyfill_cache_lock:
+        hit = _polyfill_cache.get(key)
+        if hit is not None:
+            _polyfill_cache.move_to_end(key)
+            return hit
+    cells = _polyfill_compute(ring_key, res, mode)
+    if len(cells) > _POLYFILL_CACHE_ENTRY_MAX_CELLS:
+        return cells
+    with _polyfill_cache_lock:
+        if key not in _polyfill_cache:
+            _polyfill_cache[key] = cells
+            _polyfill_cache_cells += len(cells)
+        while (len(_polyfill_cache) > _POLYFILL_CACHE_MAX_ENTRIES
+               or _polyfill_cache_cells > _POLYFILL_CACHE_MAX_CELLS):
+            _polyfill_cache_cells -= len(_polyfill_cache.popitem(last=False)[1])
+    return cells
 
 @app.post("/h3/polyfill")
-def polyfill(req: PolyfillRequest):
+async def polyfill(req: PolyfillRequest, mode: PolyfillMode = "centroid"):
     """
     Body esperado (GeoJSON):
     {
       "polygon": { "type": "Polygon", "coordinates": [[[lng,lat],...]] },
       "res": 9
     }
+    Query `mode`: centroid (padrão) | contains | intersects | covers.
     """
     rings = req.polygon.coordinates
     if not rings or not rings[0] or len(rings[0]) < 3:
         raise HTTPException(400, "Polígono inválido: mínimo de 3 pontos no anel externo.")
 
-    # anel externo em [lng,lat]
-    ring_lnglat = _normalize_ring_lnglat(rings[0])
-
-    # GeoJSON fechado para chamadas diretas
-    gj = {"type": "Polygon", "coordinates": [ring_lnglat + [ring_lnglat[0]]]}
-
-   
+    # anel externo em [lng,lat], aberto, convertido p/ numpy uma única vez
     try:
-        if hasattr(h3, "polygon_to_cells"):
-            cells = _polyfill_try_v4(gj, req.res)
-        elif hasattr(h3, "polyfill"):
-            cells = _polyfill_try_v3(gj, req.res)
+        ring = _ring_array(rings[0])
+    except ValueError as e:
+        raise HTTPException(400, f"Polígono inválido: {e}.")
+    key = ring.tobytes()  # chave hashable p/ o cache
+    if mode != "centroid" and _POLYGON_TO_CELLS_EXP is None:
+        raise HTTPException(400, f"mode={mode} requer h3 >= 4.1 (polygon_to_cells_experimental).")
+
+    # endpoints são async: polyfill grande roda fora do event loop
+    try:
+        if _bbox_cell_estimate(_bbox(ring), req.res) > _POLYFILL_THREAD_MIN_CELLS:
+            result = await asyncio.to_thread(_polyfill_cached, key, req.res, mode)
         else:
-            raise RuntimeError("Bindings H3 sem polygon_to_cells/polyfill.")
-    except Exception:
-        # fallback robusto
-        cells = _sample_polyfill(ring_lnglat, req.res)
+            result = _polyfill_cached(key, req.res, mode)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    # lista nova a cada request: o chamador pode mutar sem sujar o cache
+    cells = list(result)
     return {"cells": cells, "count": len(cells)}
-
-
-
-
-
@@ -0,0 +1,91 @@
+# Parquet H3 compartilhado pelos scripts: ids uint64 <-> hex, célula-pai em uint64 e
+# saída hive particionada (h3_parent=<id>/) gravada pelos ingest_* e podada pelo query_h3
+
+import os, shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as pads
+import h3
+
+try:
+    from h3ronpy import cells_parse as _rs_cells_parse  # opcional: parse em lote (Rust)
+except Exception:
+    _rs_cells_parse = None
+
+_str_to_int = getattr(h3, "str_to_int", None) or getattr(h3, "string_to_h3")
+_int_to_str = getattr(h3, "int_to_str", None) or getattr(h3, "h3_to_string")
+
+def cells_to_u64(cells):
+    """ids H3 (str ou int) -> np.uint64; parquet atual já vem em uint64 (só cast)."""
+    arr = np.asarray(cells)
+    if arr.dtype.kind in "iu":
+        return arr.astype(np.uint64)
+    if _rs_cells_parse is not None:
+        return np.asarray(_rs_cells_parse(list(cells)), dtype=np.uint64)
+    return np.fromiter(map(_str_to_int, cells), dtype=np.uint64, count=len(cells))
+
+def cells_to_str(cells_u64):
+    """np.uint64 -> lista de ids em hex (GeoJSON, CSV, deck.gl: uint64 não cabe em double)."""
+    return [_int_to_str(c) for c in np.asarray(cells_u64, dtype=np.uint64).tolist()]
+
+# com --filter-cells o query_h3 descarta diretórios h3_parent=<id>/ inteiros
+# antes de abrir qualquer arquivo
+PARTITION_FIELD = "h3_parent"
+DEFAULT_PARTITION_RES = 5
+
+def resolve_partition_res(partition_res, res: int) -> int:
+    """--partition-res efetivo p/ células em `res`: sem valor, min(DEFAULT_PARTITION_RES, res)
+    (res grossa não quebra); valor explícito acima de `res` sai logo, antes de qualquer I/O."""
+    if partition_res is None:
+        return min(DEFAULT_PARTITION_RES, res)
+    if partition_res < 0 or partition_res > res:
+        raise SystemExit(f"--partition-res {partition_res} fora de [0, --res {res}]")
+    return partition_res
+
+def cell_res(cells):
+    """Resolução de cada célula uint64 (bits 52-55 do índice)."""
+    return (np.asarray(cells, dtype=np.uint64) >> np.uint64(52)) & np.uint64(0xF)
+
+def cell_parent_u64(cells, res: int):
+    """cell_to_parent vetorizado: troca a resolução e marca os dígitos abaixo dela com 7.
+    Supõe `res` <= resolução das células."""
+    cells = np.asarray(cells, dtype=np.uint64)
+    out = (cells & ~np.uint64(0xF << 52)) | np.uint64(res << 52)
+    return out | np.uint64((1 << (3 * (15 - res))) - 1)
+
+def _remove_output(out_path: str):
+    # saída anterior sai inteira, em qualquer modo: partições h3_parent de outra
+    # rodada não podem se misturar ao dataset novo
+    if os.path.isdir(out_path):
+        stray = [e for e in os.listdir(out_path) if not e.startswith(PARTITION_FIELD + "=")]
+        if stray:
+            raise SystemExit(f"{out_path}: diretório não é um dataset {PARTITION_FIELD}=<id>/ (contém {stray[:3]}); não removido")
+        shutil.rmtree(out_path)
+    elif os.path.exists(out_path):
+        os.remove(out_path)
+
+def write_h3_parquet(df, cells_u64, out_path: str, partition_res: int):
+    """Grava `df` em `out_path`: arquivo único (partition_res=0) ou dataset hive
+    particionado pela célula-pai de `cells_u64` na resolução `partition_res`."""
+    cells_u64 = np.asarray(cells_u64, dtype=np.uint64)
+    if partition_res and cells_u64.size and int(cell_res(cells_u64).min()) < partition_res:
+        raise SystemExit(f"--partition-res {partition_res} maior que a resolução das células")
+    _remove_output(out_path)
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    if not partition_res:
+        df.to_parquet(out_path, index=False)
+        return
+    parents = cell_parent_u64(cells_u64, partition_res)
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    if parents.size > 1 and (parents[1:] < parents[:-1]).any():
+        # pais contíguos: cada partição é escrita de uma vez, mesmo c/ o LRU de arquivos abertos
+        order = np.argsort(parents, kind="stable")
+        tbl, parents = tbl.take(pa.array(order)), parents[order]
+    tbl = tbl.append_column(PARTITION_FIELD, pa.array(parents, type=pa.uint64()))
+    # escala estadual em res 5 passa fácil dos 1024 pais do padrão do pyarrow
+    n_parts = int(np.count_nonzero(np.diff(parents))) + 1 if parents.size else 1
+    pads.write_dataset(
+        tbl, out_path, format="parquet",
+        partitioning=pads.partitioning(pa.schema([(PARTITION_FIELD, pa.uint64())]), flavor="hive"),
+        max_partitions=max(1024, n_parts),
+    )
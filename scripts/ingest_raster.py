@@ -1,21 +1,82 @@
 ﻿#!/usr/bin/env python
 # Ingestão raster H3 (NDVI) — com reprojeção para EPSG:4326
 
-import argparse, os
+import argparse
 import numpy as np
 import pandas as pd
 import rasterio as rio
-import h3
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
+import h3.api.numpy_int as h3i  # células como uint64, inclusive no parquet
+
+from h3_parquet import resolve_partition_res, write_h3_parquet  # scripts/h3_parquet.py
 
 try:
     from pyproj import Transformer  # precisa estar disponível no container ingest
 except Exception:
     Transformer = None
 
-def to_cell(lat, lng, res: int) -> str:
-    if hasattr(h3, 'latlng_to_cell'):
-        return h3.latlng_to_cell(lat, lng, res)
-    return h3.geo_to_h3(lat, lng, res)
+# NDVI em [-1, 1] quantizado p/ int16 (escala 10000): metade dos bytes de float32
+NDVI_SCALE = 10000
+NDVI_NODATA = -32768
+# lado do bloco (pixels já decimados) da varredura: os arrays de cada bloco cabem no L2
+TILE = 1024
+
+# resolvida uma vez no import (v4 -> v3): sem hasattr por pixel no laço do np.fromiter
+to_cell = getattr(h3i, 'latlng_to_cell', None) or h3i.geo_to_h3
+
+def read_ndvi_block(ds, win: Window, out_shape, red_band: int, nir_band: int):
+    """
+    Lê a janela `win` já decimada p/ `out_shape` (média dos pixels; GDAL usa
+    overviews do COG quando houver) e devolve o NDVI quantizado em int16,
+    NDVI_NODATA onde inválido.
+    """
+    red = ds.read(red_band, window=win, out_shape=out_shape, resampling=Resampling.average).astype('float32')
+    nir = ds.read(nir_band, window=win, out_shape=out_shape, resampling=Resampling.average).astype('float32')
+
+    # ---- máscara de validade
+    try:
+        m1 = ds.read_masks(red_band, window=win, out_shape=out_shape) > 0
+        m2 = ds.read_masks(nir_band, window=win, out_shape=out_shape) > 0
+        valid = m1 & m2
+    except Exception:
+        valid = np.isfinite(red) & np.isfinite(nir)
+
+    # ---- NDVI (quantizado p/ int16; NDVI_NODATA onde inválido)
+    ndvi = (nir - red) / (nir + red + 1e-6)
+    valid &= np.isfinite(ndvi)
+    ndvi_q = np.clip(np.rint(np.where(valid, ndvi, 0) * NDVI_SCALE), -NDVI_SCALE, NDVI_SCALE).astype(np.int16)
+    ndvi_q[~valid] = NDVI_NODATA
+    return ndvi_q
+
+def tile_cells(block, t, transformer, res: int):
+    """
+    Indexa um bloco de NDVI quantizado: centros dos pixels via affine `t` do
+    bloco, reprojeção numa chamada e H3. Retorna (cells uint64, ndvi_q int16) válidos.
+    """
+    rows, cols = np.nonzero(block != NDVI_NODATA)
+    vals = block[rows, cols]
+
+    # coord do centro do pixel no CRS do raster (mesmo que ds.xy, via affine)
+    cc, rr = cols + 0.5, rows + 0.5
+    xs = t.a * cc + t.b * rr + t.c
+    ys = t.d * cc + t.e * rr + t.f
+
+    # reprojeta o bloco numa chamada só (pyproj aceita arrays)
+    if transformer is not None:
+        lons, lats = transformer.transform(xs, ys)  # always_xy=True: (x=lon/easting, y=lat/northing)
+    else:
+        lons, lats = xs, ys  # já é lon/lat
+
+    # descarta coordenadas que o H3 não aceita (antes: try/except por pixel)
+    lons, lats = np.asarray(lons, dtype='float64'), np.asarray(lats, dtype='float64')
+    ok = np.isfinite(lons) & np.isfinite(lats) & (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+    lons, lats, vals = lons[ok], lats[ok], vals[ok]
+
+    cells = np.fromiter((to_cell(la, lo, res) for la, lo in zip(lats.tolist(), lons.tolist())),
+                        dtype=np.uint64, count=lats.size)
+    return cells, vals
 
 def main():
     ap = argparse.ArgumentParser(description='Raster -> H3 NDVI')
@@ -26,34 +87,21 @@ def main():
     ap.add_argument('--step', type=int, default=4, help='amostra a cada N pixels (>=1)')
     ap.add_argument('--max-pixels', type=int, default=400000, help='limite aprox. de pixels processados')
     ap.add_argument('--out', dest='out_parquet', default='data/raster_h3.parquet')
+    ap.add_argument('--partition-res', type=int, default=None,
+                    help='res da célula-pai p/ particionar a saída (padrão: min(5, --res); 0 = arquivo único)')
     args = ap.parse_args()
+    args.partition_res = resolve_partition_res(args.partition_res, args.res)
 
     with rio.open(args.in_tif) as ds:
         # ---- info básica
         crs = ds.crs
         print(f'[ingest] arquivo={args.in_tif}  CRS={crs}')
 
-        # ---- lê bandas como float32
-        red = ds.read(args.red_band).astype('float32')
-        nir = ds.read(args.nir_band).astype('float32')
-
-        # ---- máscara de validade
-        try:
-            m1 = ds.read_masks(args.red_band) > 0
-            m2 = ds.read_masks(args.nir_band) > 0
-            valid = m1 & m2
-        except Exception:
-            valid = np.isfinite(red) & np.isfinite(nir)
-
-        # ---- NDVI
-        ndvi = (nir - red) / (nir + red + 1e-6)
-        ndvi[~valid] = np.nan
-
-        H, W = ndvi.shape
+        H, W = ds.height, ds.width
         # mantém seu controle de carga
         step_from_cap = max(1, (H * W) // max(1, args.max_pixels))
         step = max(1, max(step_from_cap, args.step))
-        print(f'[ingest] shape={H}x{W}  step={step}')
+        print(f'[ingest] shape={H}x{W}  step={step} (max-pixels => {step_from_cap}, --step={args.step})')
 
         # ---- transformer para EPSG:4326 (lon/lat)
         dst_epsg = "EPSG:4326"
@@ -64,42 +112,39 @@ def main():
             transformer = None
             print('[ingest] sem reprojeção (já em EPSG:4326 ou pyproj ausente)')
 
-        acc = {}  # cell -> [soma_ndvi, contagem]
-
-        for i in range(0, H, step):
-            for j in range(0, W, step):
-                v = ndvi[i, j]
-                if np.isnan(v):
+        # ---- varre em janelas de TILE*step pixels, cada uma lida já decimada por
+        #      `step` (sem carregar a banda inteira); cada bloco reduz p/
+        #      (célula, soma, contagem) local, fundidos no fim
+        win_side = TILE * step
+        part_cells, part_sums, part_cnts = [], [], []
+        for bi in range(0, H, win_side):
+            for bj in range(0, W, win_side):
+                win = Window(bj, bi, min(win_side, W - bj), min(win_side, H - bi))
+                out_shape = (max(1, -(-win.height // step)), max(1, -(-win.width // step)))
+                block = read_ndvi_block(ds, win, out_shape, args.red_band, args.nir_band)
+                # affine do bloco decimado: janela reescalada p/ out_shape
+                t = ds.window_transform(win) * Affine.scale(win.width / out_shape[1], win.height / out_shape[0])
+                cells, vals = tile_cells(block, t, transformer, args.res)
+                if cells.size == 0:
                     continue
+                u, inv = np.unique(cells, return_inverse=True)
+                part_cells.append(u)
+                part_sums.append(np.bincount(inv, weights=vals.astype(np.int64)))
+                part_cnts.append(np.bincount(inv))
 
-                # coord no CRS do raster
-                x, y = ds.xy(i, j)
-
-                # reprojeta para lon/lat se necessário
-                if transformer is not None:
-                    lon, lat = transformer.transform(x, y)  # always_xy=True: (x=lon/easting, y=lat/northing)
-                else:
-                    lon, lat = float(x), float(y)  # já é lon/lat
-
-                # guarda no H3
-                try:
-                    cell = to_cell(lat, lon, args.res)
-                except Exception:
-                    continue
-
-                s = acc.get(cell)
-                if s is None:
-                    acc[cell] = [float(v), 1]
-                else:
-                    s[0] += float(v); s[1] += 1
-
-    if not acc:
+    if not part_cells:
         raise SystemExit('Nenhuma célula acumulada (NDVI todo NaN?).')
 
-    rows = [{'cell_h3': c, 'ndvi_mean': s[0] / s[1]} for c, s in acc.items()]
-    os.makedirs(os.path.dirname(args.out_parquet) or '.', exist_ok=True)
-    pd.DataFrame(rows).to_parquet(args.out_parquet, index=False)
-    print(f'[ingest] Gerado {args.out_parquet} com {len(rows)} linhas.')
+    # média por célula: soma e contagem via bincount (laço em C, sem dict/groupby)
+    uniq, inv = np.unique(np.concatenate(part_cells), return_inverse=True)
+    sums = np.bincount(inv, weights=np.concatenate(part_sums))
+    cnts = np.bincount(inv, weights=np.concatenate(part_cnts))
+    mean = sums / cnts / NDVI_SCALE  # volta p/ float só no fim (parquet segue float)
+
+    # cell_h3 gravada como uint64 (8 bytes/célula, sem str)
+    out = pd.DataFrame({'cell_h3': uniq.astype(np.uint64), 'ndvi_mean': mean})
+    write_h3_parquet(out, uniq, args.out_parquet, args.partition_res)
+    print(f'[ingest] Gerado {args.out_parquet} com {len(out)} linhas.')
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,18 @@
 #!/usr/bin/env python
-import argparse, os, json, h3, pandas as pd
+import argparse, os, h3, orjson
+from functools import lru_cache
+import pyarrow as pa
+import pyarrow.dataset as ds
 
+from h3_parquet import cells_to_str  # scripts/h3_parquet.py
+
+BATCH_SIZE = 65536
+
+# ~1 lote: células quase não se repetem entre lotes (raster = 1 linha por célula),
+# então um cache sem teto só cresceria; as repetidas dentro do lote o dict.fromkeys já pega
+@lru_cache(maxsize=BATCH_SIZE)
 def cell_boundary(cell):
+    # memoizado: o dict devolvido é compartilhado, não mutar
     if hasattr(h3, "cell_to_boundary"):
         coords = h3.cell_to_boundary(cell)    # [(lat,lng), ...]
     else:
@@ -17,20 +28,34 @@ def main():
     ap.add_argument("--ndvi-col", default="ndvi_mean")
     args = ap.parse_args()
 
-    df = pd.read_parquet(args.in_parquet)
-    if "cell_h3" not in df.columns or args.ndvi_col not in df.columns:
+    # arquivo único ou dataset hive (h3_parent=<id>/) gravado pelos ingest_*
+    dset = ds.dataset(args.in_parquet, format="parquet", partitioning="hive")
+    names = dset.schema.names
+    if "cell_h3" not in names or args.ndvi_col not in names:
         raise SystemExit("Parquet precisa ter colunas: cell_h3 e ndvi_mean (ou --ndvi-col).")
 
-    feats = []
-    for cell, ndvi in zip(df["cell_h3"], df[args.ndvi_col]):
-        geom = cell_boundary(cell)
-        feats.append({"type":"Feature","properties":{"cell_h3":cell,"ndvi_mean":float(ndvi)},"geometry":geom})
-
-    fc = {"type":"FeatureCollection","features":feats}
+    # escreve em fluxo, lote a lote: sem montar a FeatureCollection inteira na RAM
     os.makedirs(os.path.dirname(args.out_geojson) or ".", exist_ok=True)
-    with open(args.out_geojson, "w", encoding="utf-8") as f:
-        json.dump(fc, f, ensure_ascii=False)
-    print(f"GeoJSON salvo: {args.out_geojson} ({len(feats)} hex)")
+    n = 0
+    with open(args.out_geojson, "wb") as f:
+        f.write(b'{"type":"FeatureCollection","features":[')
+        for batch in dset.to_batches(batch_size=BATCH_SIZE, columns=["cell_h3", args.ndvi_col]):
+            col = batch.column(0)
+            # cell_h3 em uint64 (ingest atual) ou str (parquet antigo); GeoJSON leva hex
+            cells = cells_to_str(col.to_numpy()) if pa.types.is_integer(col.type) else col.to_pylist()
+            ndvis = batch.column(1).to_pylist()
+            if not cells:
+                continue
+            # uma geometria por célula distinta do lote (células repetem entre linhas)
+            geoms = {c: cell_boundary(c) for c in dict.fromkeys(cells)}
+            chunk = b",".join(
+                orjson.dumps({"type":"Feature","properties":{"cell_h3":cell,"ndvi_mean":ndvi},"geometry":geoms[cell]})
+                for cell, ndvi in zip(cells, ndvis)
+            )
+            f.write(b"," + chunk if n else chunk)
+            n += len(cells)
+        f.write(b"]}")
+    print(f"GeoJSON salvo: {args.out_geojson} ({n} hex)")
 
 if __name__ == "__main__":
     main()
@@ -2,16 +2,209 @@
 # Consulta H3: join de vetor + raster por celula, filtros básicos e export
 
 import argparse, os, sys, json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-def load_df(path, required_cols):
+# entradas gravadas pelos ingest_* como dataset hive h3_parent=<id>/
+from h3_parquet import PARTITION_FIELD, cell_res, cell_parent_u64, cells_to_str, cells_to_u64  # scripts/h3_parquet.py
+
+try:
+    import polars as pl  # opcional: --engine polars
+except Exception:
+    pl = None
+
+# saída ordenada por cell_h3 em zstd: min/max justos por row group p/ quem filtrar depois
+OUT_ROW_GROUP_SIZE = 1_000_000
+OUT_ZSTD_LEVEL = 3
+
+def write_sorted_parquet(tbl, path):
+    """Grava `tbl` (já ordenada por cell_h3) com estatísticas e marca a ordenação no footer."""
+    pq.write_table(
+        tbl, path,
+        compression="zstd", compression_level=OUT_ZSTD_LEVEL,
+        row_group_size=OUT_ROW_GROUP_SIZE,
+        use_dictionary=True,  # atributos de baixa cardinalidade; ids caem p/ plain sozinhos
+        write_statistics=True,
+        sorting_columns=[pq.SortingColumn(tbl.schema.get_field_index("cell_h3"))],
+    )
+
+def _partition_parents(dset, cells):
+    """Células-pai (na res da partição h3_parent) do filtro; None se não dá p/ podar."""
+    if PARTITION_FIELD not in dset.schema.names:
+        return None
+    frag = next(iter(dset.get_fragments()), None)
+    keys = ds.get_partition_keys(frag.partition_expression) if frag is not None else {}
+    if PARTITION_FIELD not in keys:
+        return None
+    pres = int(cell_res([int(keys[PARTITION_FIELD])])[0])  # valor inferido pode vir como str
+    if int(cell_res(cells).min()) < pres:
+        return None
+    return np.unique(cell_parent_u64(cells, pres))
+
+def _partition_filter(dset, cells):
+    """Predicado sobre h3_parent (poda de diretórios); None se não dá p/ podar."""
+    parents = _partition_parents(dset, cells)
+    if parents is None:
+        return None
+    ftype = dset.schema.field(PARTITION_FIELD).type
+    return pc.field(PARTITION_FIELD).isin(pa.array(parents, type=pa.uint64()).cast(ftype))
+
+def agg_stats(keys, vals):
+    """count/mean/min/max de `vals` por chave sem groupby: count/soma via bincount
+    (sem ordenar), min/max via sort + reduceat. Mesma saída de
+    groupby(keys, observed=True)[...].agg(["count","mean","min","max"]): chaves nulas
+    ficam de fora, NaN não conta, chave só com NaN sai com count=0 e estatísticas NaN,
+    categórica só gera as categorias presentes."""
+    codes, uniq = pd.factorize(keys, sort=True)
+    vals = np.asarray(vals, dtype=np.float64)
+    seen = np.bincount(codes[codes >= 0], minlength=len(uniq)) > 0
+    ok = (codes >= 0) & ~np.isnan(vals)
+    codes, vals = codes[ok], vals[ok]
+    counts = np.bincount(codes, minlength=len(uniq))
+    sums = np.bincount(codes, weights=vals, minlength=len(uniq))
+    vmin = np.full(len(uniq), np.nan)
+    vmax = np.full(len(uniq), np.nan)
+    if codes.size:
+        order = np.argsort(codes, kind="stable")
+        sc, sv = codes[order], vals[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(sc)) + 1))
+        vmin[sc[starts]] = np.minimum.reduceat(sv, starts)
+        vmax[sc[starts]] = np.maximum.reduceat(sv, starts)
+    present = np.flatnonzero(seen)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums[present] / counts[present]  # count 0 -> NaN
+    # chave já como 1ª coluna (sem insert/reset_index copiando o frame depois)
+    return pd.DataFrame({
+        keys.name: uniq[present],
+        "count": counts[present],
+        "mean": mean,
+        "min": vmin[present],
+        "max": vmax[present],
+    })
+
+def _projection(names, required_cols, extra_cols):
+    """Colunas a ler: obrigatórias + extras existentes; extra_cols=None lê todas."""
+    if extra_cols is None:
+        return [c for c in names if c != PARTITION_FIELD]
+    return list(dict.fromkeys(list(required_cols) + [c for c in extra_cols if c in names]))
+
+def load_table(path, required_cols, extra_cols=(), cells=None):
+    """Lê parquet (arquivo ou dataset hive) como pyarrow.Table. Com `cells` (uint64) o
+    filtro desce ao leitor: poda partições h3_parent e row groups cujo min/max de
+    cell_h3 não cobre o filtro."""
     if not os.path.exists(path):
         raise SystemExit(f"Arquivo não encontrado: {path}")
-    df = pd.read_parquet(path)
-    miss = [c for c in required_cols if c not in df.columns]
+    dset = ds.dataset(path, format="parquet", partitioning="hive")
+    miss = [c for c in required_cols if c not in dset.schema.names]
     if miss:
         raise SystemExit(f"Colunas ausentes em {path}: {miss}")
-    return df
+    flt = None
+    if cells is not None:
+        # o literal do filtro precisa ter o mesmo tipo da coluna gravada (str ou uint64)
+        if pa.types.is_integer(dset.schema.field("cell_h3").type):
+            values = pa.array(cells, type=pa.uint64())
+        else:
+            values = pa.array(cells_to_str(cells), type=pa.string())
+        flt = pc.field("cell_h3").isin(values)
+        pflt = _partition_filter(dset, cells)
+        if pflt is not None:
+            flt = pflt & flt
+    # só as colunas usadas: column chunks das demais nem são lidos/descomprimidos
+    tbl = dset.to_table(columns=_projection(dset.schema.names, required_cols, extra_cols), filter=flt)
+    i = tbl.schema.get_field_index("cell_h3")
+    col = tbl.column(i)
+    if pa.types.is_integer(col.type):
+        col = col.cast(pa.uint64())
+    else:  # parquet antigo com cell_h3 em str
+        col = pa.array(cells_to_u64(col.to_pylist()), type=pa.uint64())
+    # sem o metadata pandas do arquivo: num parquet antigo ele diria "cell_h3 é str" e o
+    # to_pandas() converteria o uint64 de volta
+    return tbl.set_column(i, "cell_h3", col).replace_schema_metadata(None)
+
+def scan_polars(path, required_cols, extra_cols=(), cells=None):
+    """Equivalente lazy (polars) do load_table: mesmas podas, cell_h3 sai UInt64."""
+    if not os.path.exists(path):
+        raise SystemExit(f"Arquivo não encontrado: {path}")
+    lf = pl.scan_parquet(path, hive_partitioning=os.path.isdir(path))
+    schema = lf.collect_schema()
+    miss = [c for c in required_cols if c not in schema.names()]
+    if miss:
+        raise SystemExit(f"Colunas ausentes em {path}: {miss}")
+    is_str = schema["cell_h3"] == pl.String
+    if cells is not None:
+        # filtro na coluna crua (tipo gravado) p/ descer ao leitor; partição antes
+        parents = _partition_parents(ds.dataset(path, format="parquet", partitioning="hive"), cells) \
+            if PARTITION_FIELD in schema.names() else None
+        if parents is not None:
+            lf = lf.filter(pl.col(PARTITION_FIELD).is_in(pl.Series(parents).cast(schema[PARTITION_FIELD]).implode()))
+        values = pl.Series(cells_to_str(cells)) if is_str else pl.Series(cells, dtype=pl.UInt64)
+        lf = lf.filter(pl.col("cell_h3").is_in(values.implode()))
+    cell = pl.col("cell_h3").str.to_integer(base=16) if is_str else pl.col("cell_h3")
+    return lf.select(_projection(schema.names(), required_cols, extra_cols)).with_columns(cell.cast(pl.UInt64))
+
+def _vector_extra_cols(args):
+    """Atributos do vetor a carregar: todos (padrão, mesma saída de sempre) ou, com
+    --keep-cols, só --agg-by + as colunas pedidas."""
+    keep = [c.strip() for c in (args.keep_cols or "all").split(",") if c.strip()]
+    if not keep or "all" in keep:
+        return None
+    return ([args.agg_by] if args.agg_by else []) + keep
+
+def run_polars(args, cells):
+    """query_h3 no polars: scans lazy com as mesmas podas, join materializado uma vez."""
+    if pl is None:
+        raise SystemExit("--engine polars requer o pacote polars.")
+    lv = scan_polars(args.vector, ["cell_h3"], _vector_extra_cols(args), cells=cells)
+    lr = scan_polars(args.raster, ["cell_h3", "ndvi_mean"], cells=cells)
+
+    # m:1 = mesma checagem de célula única no raster do caminho arrow. o join é
+    # materializado uma vez só: resumo, --agg-by e saída saem do mesmo DataFrame (sem
+    # reexecutar scan + join + sort a cada collect/sink do plano lazy)
+    joined = (lv.join(lr, on="cell_h3", how="inner", validate="m:1")
+                .sort("cell_h3", maintain_order=True)
+                .collect())
+
+    n, mean, vmin, vmax = joined.select(
+        pl.len(), pl.col("ndvi_mean").mean().alias("mean"),
+        pl.col("ndvi_mean").min().alias("min"), pl.col("ndvi_mean").max().alias("max"),
+    ).row(0)
+    if n == 0:
+        print("Sem resultados após o join.")
+        sys.exit(0)
+
+    print(f"Linhas no join: {n}")
+    print(f"NDVI média: {mean:.4f}  |  min: {vmin:.4f}  |  max: {vmax:.4f}")
+
+    if args.agg_by and args.agg_by in joined.columns:
+        # NaN sai só das estatísticas: chave só com NaN fica com count=0 (como no agg_stats)
+        v = pl.col("ndvi_mean").filter(pl.col("ndvi_mean").is_not_nan())
+        nan = float("nan")
+        grp = (joined.filter(pl.col(args.agg_by).is_not_null())
+                  .group_by(args.agg_by)
+                  .agg(v.count().cast(pl.Int64).alias("count"), v.mean().fill_null(nan).alias("mean"),
+                       v.min().fill_null(nan).alias("min"), v.max().fill_null(nan).alias("max"))
+                  .sort(args.agg_by))
+        print("\nAgregado por", args.agg_by)
+        print(grp.head(20).to_pandas().to_string(index=False))
+        base, ext = os.path.splitext(args.out)
+        grp.write_parquet(base + f".agg_by_{args.agg_by}" + ext)
+        if args.out_csv:
+            grp.write_csv(os.path.splitext(args.out_csv)[0] + f".agg_by_{args.agg_by}.csv")
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    # saída com 1 linha por célula (o viz_map não agrega); ndvi_mean é o mesmo nas repetidas
+    out = joined.unique(subset="cell_h3", keep="first", maintain_order=True)
+    out.write_parquet(args.out, compression="zstd", compression_level=OUT_ZSTD_LEVEL,
+                      row_group_size=OUT_ROW_GROUP_SIZE, statistics=True)
+    if args.out_csv:
+        out.with_columns(pl.Series("cell_h3", cells_to_str(out["cell_h3"].to_numpy()), dtype=pl.String)) \
+           .write_csv(args.out_csv)
+    if args.verbose:
+        print(f"Salvo: {args.out}  |  {args.out_csv or '(sem CSV)'}")
 
 def main():
     ap = argparse.ArgumentParser(description="Query H3 (vector + raster)")
@@ -21,32 +214,49 @@ def main():
     ap.add_argument("--out-csv", default=None)
     ap.add_argument("--filter-cells", default=None, help="Caminho p/ JSON com lista de cells H3")
     ap.add_argument("--agg-by", default=None, help="Coluna do vetor p/ agregar (ex.: tipo)")
+    ap.add_argument("--keep-cols", default=None,
+                    help="Só estas colunas do vetor na saída, separadas por vírgula (padrão: todas)")
+    ap.add_argument("--engine", choices=["arrow", "polars"], default="arrow",
+                    help="arrow (padrão) ou polars (scans lazy, join multithread do polars)")
     ap.add_argument("--verbose", action="store_true")
     args = ap.parse_args()
 
-    dv = load_df(args.vector, ["cell_h3"])
-    dr = load_df(args.raster, ["cell_h3", "ndvi_mean"])
-
+    cells = None
     if args.filter_cells:
         cells = json.load(open(args.filter_cells, "r", encoding="utf-8"))
         if not isinstance(cells, (list, tuple)) or not cells:
             raise SystemExit("filter-cells deve ser JSON com lista de H3 cells.")
-        dv = dv[dv["cell_h3"].isin(cells)]
-        dr = dr[dr["cell_h3"].isin(cells)]
+        try:
+            cells = np.unique(cells_to_u64(list(cells)))
+        except (TypeError, ValueError) as e:
+            raise SystemExit(f"filter-cells com célula inválida: {e}")
+
+    if args.engine == "polars":
+        return run_polars(args, cells)
+
+    tv = load_table(args.vector, ["cell_h3"], _vector_extra_cols(args), cells=cells)
+    tr = load_table(args.raster, ["cell_h3", "ndvi_mean"], cells=cells)
 
-    df = pd.merge(dv, dr, on="cell_h3", how="inner")
+    # raster tem uma linha por célula; o vetor pode repetir células (feições sobrepostas)
+    if pc.count_distinct(tr.column("cell_h3")).as_py() != tr.num_rows:
+        raise SystemExit(f"{args.raster}: cell_h3 repetida no raster (esperado 1 linha por célula)")
+    # hash join do Arrow (C++, multithread) direto nas tabelas; pandas só no resultado.
+    # a ordem de saída do join não é garantida: ordena por célula p/ saída determinística
+    tj = tv.join(tr, keys="cell_h3", join_type="inner").sort_by("cell_h3")
 
-    if df.empty:
+    if tj.num_rows == 0:
         print("Sem resultados após o join.")
         sys.exit(0)
 
-    # Resumos simples
-    print(f"Linhas no join: {len(df)}")
-    print(f"NDVI média: {df['ndvi_mean'].mean():.4f}  |  min: {df['ndvi_mean'].min():.4f}  |  max: {df['ndvi_mean'].max():.4f}")
+    # Resumos simples: só as colunas usadas saem do Arrow (sem to_pandas do join inteiro);
+    # null -> NaN e nan* ignora, como o mean/min/max do pandas
+    ndvi = tj.column("ndvi_mean").to_numpy().astype(np.float64, copy=False)
+    print(f"Linhas no join: {tj.num_rows}")
+    print(f"NDVI média: {np.nanmean(ndvi):.4f}  |  min: {np.nanmin(ndvi):.4f}  |  max: {np.nanmax(ndvi):.4f}")
 
     # Agregação opcional por uma coluna do vetor
-    if args.agg_by and args.agg_by in df.columns:
-        grp = df.groupby(args.agg_by)["ndvi_mean"].agg(["count", "mean", "min", "max"]).reset_index()
+    if args.agg_by and args.agg_by in tj.column_names:
+        grp = agg_stats(tj.column(args.agg_by).to_pandas().rename(args.agg_by), ndvi)
         print("\nAgregado por", args.agg_by)
         print(grp.head(20).to_string(index=False))
         # salva também
@@ -56,10 +266,19 @@ def main():
         if args.out_csv:
             grp.to_csv(os.path.splitext(args.out_csv)[0] + f".agg_by_{args.agg_by}.csv", index=False)
 
+    # saída com 1 linha por célula (o viz_map não agrega): tj já vem ordenada, então basta
+    # a 1ª linha de cada célula; ndvi_mean é o mesmo nas repetidas (join m:1 no raster).
+    # o --agg-by acima usou todas as linhas do join (feições sobrepostas contam p/ cada uma)
+    cell = tj.column("cell_h3").to_numpy()
+    first = np.ones(len(cell), dtype=bool)
+    first[1:] = cell[1:] != cell[:-1]
+    tout = tj.filter(pa.array(first))
     os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
-    df.to_parquet(args.out, index=False)
+    write_sorted_parquet(tout, args.out)  # cell_h3 segue uint64
     if args.out_csv:
-        df.to_csv(args.out_csv, index=False)
+        # CSV é p/ leitura humana/ferramentas H3: id em hex
+        dout = tout.to_pandas()
+        dout.assign(cell_h3=cells_to_str(dout["cell_h3"].to_numpy())).to_csv(args.out_csv, index=False)
     if args.verbose:
         print(f"Salvo: {args.out}  |  {args.out_csv or '(sem CSV)'}")
 
@@ -1,40 +1,154 @@
 ﻿#!/usr/bin/env python
 # Mapa NDVI por H3 (pydeck) 
 
-import argparse, os
+import argparse, os, json
+from string import Template
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 import pydeck as pdk
-import h3
+import h3.api.numpy_int as h3i
 
-def cell_center(cell):
-    if hasattr(h3, "cell_to_latlng"):
-        lat, lng = h3.cell_to_latlng(cell)
-    else:
-        lat, lng = h3.h3_to_geo(cell)
-    return float(lat), float(lng)
+from h3_parquet import cells_to_str, cells_to_u64  # scripts/h3_parquet.py
+
+try:
+    # h3ronpy: centros em lote (Rust) sobre arrays uint64
+    from h3ronpy.vector import cells_to_coordinates as _rs_cells_to_coordinates
+except Exception:
+    _rs_cells_to_coordinates = None
+
+# sem h3ronpy: a partir daqui (células por processo) o centro de célula vai p/ um pool
+_PARALLEL_MIN_CELLS = 500_000
+
+_int_to_latlng = getattr(h3i, "cell_to_latlng", None) or getattr(h3i, "h3_to_geo")
+
+def cells_latlng(cells_u64):
+    """Centro de cada célula como array (N,2) float64 [lat, lng]."""
+    cells_u64 = np.asarray(cells_u64, dtype=np.uint64)
+    if _rs_cells_to_coordinates is not None:
+        rb = _rs_cells_to_coordinates(cells_u64)
+        return np.column_stack([np.asarray(rb.column("lat")), np.asarray(rb.column("lng"))])
+    n = len(cells_u64)
+    workers = min(os.cpu_count() or 1, max(1, n // _PARALLEL_MIN_CELLS))
+    if workers > 1:
+        # h3-py segura o GIL: threads não escalam; blocos vão p/ processos
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            return np.concatenate(list(ex.map(_latlng_chunk, np.array_split(cells_u64, workers))))
+    return _latlng_chunk(cells_u64)
+
+def _latlng_chunk(cells_u64):
+    out = np.empty((len(cells_u64), 2), dtype=np.float64)
+    for i, c in enumerate(cells_u64.tolist()):
+        out[i] = _int_to_latlng(c)
+    return out
+
+def load_centers(df, in_parquet):
+    """Anexa lat/lng ao df, usando o sidecar <in>.centers.parquet como cache."""
+    side = in_parquet + ".centers.parquet"
+    if os.path.exists(side) and os.path.getmtime(side) >= os.path.getmtime(in_parquet):
+        centers = pd.read_parquet(side, columns=["cell_h3", "lat", "lng"])
+        if centers["cell_h3"].dtype == df["cell_h3"].dtype:  # sidecar antigo tinha str
+            out = df.merge(centers, on="cell_h3", how="left")
+            if not out["lat"].isna().any():
+                return out
+    latlng = cells_latlng(df["cell_h3"].to_numpy())
+    df = df.assign(lat=latlng[:, 0], lng=latlng[:, 1])
+    try:
+        df[["cell_h3", "lat", "lng"]].drop_duplicates("cell_h3").to_parquet(side, index=False)
+    except OSError as e:
+        print(f"Aviso: não foi possível gravar {side}: {e}")
+    return df
+
+def quantiles(v, qs):
+    """Quantis com interpolação linear (como np.quantile) num único np.partition O(N)."""
+    pos = np.asarray(qs, dtype=np.float64) * (v.size - 1)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, v.size - 1)
+    part = np.partition(v, np.unique(np.concatenate([lo, hi])))
+    frac = (pos - lo).astype(v.dtype)
+    return part[lo] + (part[hi] - part[lo]) * frac
+
+def _ramp(t):
+    """Rampa em 2 trechos (vermelho -> amarelo -> verde) p/ t em [0,1] -> uint8 (N,4)."""
+    lo = t < 0.5
+    w2 = np.where(lo, t/0.5, (t-0.5)/0.5)
+    r = np.where(lo, 165.0, 165 + (0-165)*w2)
+    g = np.where(lo, (191-0)*w2, 191 + (104-191)*w2)
+    b = np.where(lo, 38 + (0-38)*w2, (55-0)*w2)
+    # valores >= 0: astype trunca igual ao int()
+    return np.stack([r, g, b, np.full_like(r, 190)], axis=1).astype(np.uint8)
 
-def make_color_scale(vals):
+# paleta de 256 cores (1 KiB, cabe no L1): por célula só um índice e um gather
+PALETTE = _ramp(np.arange(256) / 255.0)
+
+def color_index(vals):
+    """Índice na PALETTE (uint8) de cada valor, pela escala de quantis 5–95%."""
     v = np.asarray(vals, dtype="float32")
     v = v[np.isfinite(v)]
     if v.size == 0:
         vmin, vmax = 0.0, 1.0
     else:
-        vmin, vmax = np.quantile(v, 0.05), np.quantile(v, 0.95)
+        vmin, vmax = quantiles(v, (0.05, 0.95))
         if vmin == vmax: vmin, vmax = float(v.min()), float(v.max())
-    t = (np.asarray(vals) - vmin) / (vmax - vmin + 1e-12)
-    t = np.clip(t, 0, 1)
-    colors = []
-    for w in t:
-        if w < 0.5:
-            w2 = w/0.5; r=165; g=int(0+(191-0)*w2); b=int(38+(0-38)*w2)
-        else:
-            w2 = (w-0.5)/0.5; r=int(165+(0-165)*w2); g=int(191+(104-191)*w2); b=int(0+(55-0)*w2)
-        colors.append([r,g,b,190])
-    return colors, (float(vmin), float(vmax))
-
-def compute_view(cells):
-    latlng = np.array([cell_center(c) for c in cells])
+    t = (np.asarray(vals, dtype=np.float32) - np.float32(vmin)) * np.float32(255.0 / (vmax - vmin + 1e-12))
+    idx = np.rint(np.nan_to_num(np.clip(t, 0, 255), nan=0.0)).astype(np.uint8)
+    return idx, (float(vmin), float(vmax))
+
+# ---- --binary-data: células fora do HTML, num .bin little-endian lido por fetch:
+#      "H3BN" | n:u32 | ids:u64[n] (2x u32: lo, hi) | ndvi:f64[n] | paleta:u8[256*4] | cor:u8[n]
+#      sem JSON de N objetos no Python nem JSON.parse gigante no browser
+BINARY_MAGIC = b"H3BN"
+
+def write_binary_cells(path, cells_u64, ndvi, idx):
+    with open(path, "wb") as f:
+        f.write(BINARY_MAGIC)
+        f.write(np.uint32(len(cells_u64)).astype("<u4").tobytes())
+        f.write(np.asarray(cells_u64, dtype="<u8").tobytes())
+        f.write(np.asarray(ndvi, dtype="<f8").tobytes())
+        f.write(PALETTE.tobytes())
+        f.write(np.asarray(idx, dtype=np.uint8).tobytes())
+
+# injetado após o script do pydeck (usa o `deckInstance` dele): lê o .bin e troca os
+# dados da camada por clone(); id em hex montado das 2 metades (h3-js aceita string)
+_BINARY_LOADER_JS = Template("""
+<script>
+(async () => {
+  const buf = await (await fetch($url)).arrayBuffer();
+  if (new TextDecoder().decode(new Uint8Array(buf, 0, 4)) !== "H3BN") throw new Error("sidecar inválido");
+  const n = new DataView(buf).getUint32(4, true);
+  let off = 8;
+  const ids = new Uint32Array(buf, off, 2 * n); off += 8 * n;
+  const ndvi = new Float64Array(buf, off, n); off += 8 * n;
+  const pal = new Uint8Array(buf, off, 1024); off += 1024;
+  const idx = new Uint8Array(buf, off, n);
+  const data = new Array(n);
+  for (let i = 0; i < n; i++) {
+    const hi = ids[2 * i + 1].toString(16), lo = ids[2 * i].toString(16).padStart(8, "0");
+    data[i] = {cell_h3: hi + lo, ndvi_mean: ndvi[i]};
+  }
+  const getFillColor = (d, {index}) => pal.subarray(4 * idx[index], 4 * idx[index] + 4);
+  // createDeck pode montar as camadas do JSON depois do 1º frame: espera a nossa aparecer
+  while (!(deckInstance.props.layers || []).some(l => l.id === $layer_id)) {
+    await new Promise(r => requestAnimationFrame(r));
+  }
+  deckInstance.setProps({
+    layers: deckInstance.props.layers.map(l => l.id === $layer_id ? l.clone({data, getFillColor}) : l),
+  });
+})();
+</script>
+""")
+
+def inject_binary_loader(html_path, data_url, layer_id):
+    with open(html_path, "r", encoding="utf-8") as f:
+        html = f.read()
+    js = _BINARY_LOADER_JS.substitute(url=json.dumps(data_url), layer_id=json.dumps(layer_id))
+    i = html.rfind("</html>")
+    html = html[:i] + js + html[i:] if i >= 0 else html + js
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(html)
+
+def compute_view(latlng):
     lat_min, lng_min = latlng.min(axis=0); lat_max, lng_max = latlng.max(axis=0)
     lat0 = (lat_min + lat_max)/2; lng0 = (lng_min + lng_max)/2
     span = max(lat_max-lat_min, lng_max-lng_min)
@@ -49,17 +163,37 @@ def main():
     ap.add_argument("--elevation", type=float, default=0.0)
     ap.add_argument("--height", type=int, default=720)
     ap.add_argument("--mapbox-key", default=None, help="Token Mapbox (opcional; senão usa env MAPBOX_API_KEY)")
+    ap.add_argument("--binary-data", action="store_true",
+                    help="Células num .bin ao lado do HTML (fetch; servir via HTTP, não abre em file://)")
     args = ap.parse_args()
 
-    df = pd.read_parquet(args.in_parquet)
-    if "cell_h3" not in df.columns or "ndvi_mean" not in df.columns:
+    if not {"cell_h3", "ndvi_mean"} <= set(pq.read_schema(args.in_parquet).names):
         raise SystemExit("Parquet precisa ter cell_h3 e ndvi_mean")
-    df = df.groupby("cell_h3", as_index=False).agg({"ndvi_mean":"mean"})
+    # só o que vai p/ o mapa: atributos extras (--keep-cols) não entram no payload
+    df = pd.read_parquet(args.in_parquet, columns=["cell_h3", "ndvi_mean"])
+    df["cell_h3"] = cells_to_u64(df["cell_h3"].to_numpy())
+    # query_h3 já grava uma linha por célula: nada a agregar aqui
+    if not df["cell_h3"].is_unique:
+        raise SystemExit("cell_h3 repetida no parquet; gere de novo com o query_h3 (saída deduplicada)")
 
-    colors, (vmin, vmax) = make_color_scale(df["ndvi_mean"].to_numpy())
-    df["_color"] = colors; df["_line_color"] = [[40,40,40,120]]*len(df)
+    idx, (vmin, vmax) = color_index(df["ndvi_mean"].to_numpy())
+    if not args.binary_data:
+        # cor em 3 colunas uint8 (sem lista Python por linha); o alfa é constante no accessor
+        colors = PALETTE[idx]
+        df["_r"], df["_g"], df["_b"] = colors[:, 0], colors[:, 1], colors[:, 2]
 
-    view_state = compute_view(df["cell_h3"])
+    df = load_centers(df, args.in_parquet)
+    view_state = compute_view(df[["lat", "lng"]].to_numpy())
+    df = df.drop(columns=["lat", "lng"])
+    os.makedirs(os.path.dirname(args.out_html) or ".", exist_ok=True)
+    if args.binary_data:
+        bin_path = os.path.splitext(args.out_html)[0] + ".cells.bin"
+        write_binary_cells(bin_path, df["cell_h3"].to_numpy(), df["ndvi_mean"].to_numpy(), idx)
+        layer_data = []  # preenchido no browser a partir do .bin
+    else:
+        # deck.gl/h3-js recebe o id em hex: uint64 no JSON perderia precisão (> 2^53)
+        df["cell_h3"] = cells_to_str(df["cell_h3"].to_numpy())
+        layer_data = df
 
     # Mapbox key (CLI tem prioridade; senão ENV; senão None)
     key = args.mapbox_key or os.environ.get("MAPBOX_API_KEY")
@@ -73,11 +207,12 @@ def main():
 
     hex_layer = pdk.Layer(
         "H3HexagonLayer",
-        df,
+        layer_data,
+        id="ndvi-h3",
         pickable=True, auto_highlight=True,
         get_hexagon="cell_h3",
-        get_fill_color="_color",
-        get_line_color="_line_color",
+        get_fill_color="[_r, _g, _b, 190]",  # expressão deck.gl; alfa igual ao da PALETTE
+        get_line_color=[40, 40, 40, 120],  # constante: nada por célula no payload
         stroked=True, line_width_min_pixels=1,
         extruded=bool(args.elevation > 0),
         get_elevation=f"ndvi_mean * {args.elevation}" if args.elevation > 0 else 0,
@@ -91,8 +226,9 @@ def main():
                     map_style=map_style, tooltip=tooltip, height=args.height)
 
     deck.description = f"NDVI ~ quantis 5–95% | min={vmin:.3f} | max={vmax:.3f}"
-    os.makedirs(os.path.dirname(args.out_html) or ".", exist_ok=True)
     deck.to_html(args.out_html, notebook_display=False)
+    if args.binary_data:
+        inject_binary_loader(args.out_html, os.path.basename(bin_path), hex_layer.id)
     print(f"Mapa salvo em {args.out_html} ({len(df)} células). Mapbox={'ON' if key else 'OFF'}.")
 
 if __name__ == "__main__":
@@ -1,40 +1,67 @@
-﻿import pytest
-from fastapi.testclient import TestClient
+﻿from collections import OrderedDict
+
+import httpx
+import numpy as np
+import pytest
 import h3
 
+import app as svc
 from app import app
 
-client = TestClient(app)
+# testes async no mesmo event loop do app (ASGITransport), sem a thread/portal do TestClient
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+async def client():
+    # um client p/ a sessão inteira; o app não tem lifespan (ASGITransport não o roda)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as c:
+        yield c
 
-def test_health():
-    r = client.get("/healthz")
+@pytest.fixture(scope="session")
+async def example_cell(client):
+    r = await client.get("/h3/index?lat=-23.5505&lng=-46.6333&res=9")
+    assert r.status_code == 200
+    return r.json()["cell"]
+
+async def test_health(client):
+    r = await client.get("/healthz")
     assert r.status_code == 200
     data = r.json()
     assert data["status"] == "ok"
     assert "h3_version" in data
 
-def test_index_and_boundary():
-    lat, lng, res = -23.5505, -46.6333, 9
-    r = client.get(f"/h3/index?lat={lat}&lng={lng}&res={res}")
-    assert r.status_code == 200
-    cell = r.json()["cell"]
-    assert isinstance(cell, str)
+async def test_index_and_boundary(client, example_cell):
+    assert isinstance(example_cell, str)
 
-    r2 = client.get(f"/h3/boundary/{cell}")
+    r2 = await client.get(f"/h3/boundary/{example_cell}")
     assert r2.status_code == 200
     boundary = r2.json()["boundary"]
     assert isinstance(boundary, list)
     assert len(boundary) >= 6
 
-def test_kring():
-    lat, lng, res = -23.5505, -46.6333, 9
-    cell = client.get(f"/h3/index?lat={lat}&lng={lng}&res={res}").json()["cell"]
-    r = client.get(f"/h3/kring?cell={cell}&k=1")
+async def test_kring(client, example_cell):
+    r = await client.get(f"/h3/kring?cell={example_cell}&k=1")
     assert r.status_code == 200
     cells = r.json()["cells"]
     assert len(cells) >= 7  # central + vizinhos
 
-def test_polyfill():
+async def test_int_cell_ids(client, example_cell):
+    cell = example_cell
+    as_int = h3.str_to_int(cell)  # como os parquets guardam cell_h3 (uint64)
+
+    r = await client.get(f"/h3/boundary/{as_int}")
+    assert r.status_code == 200
+    assert r.json() == (await client.get(f"/h3/boundary/{cell}")).json()
+
+    r = await client.get(f"/h3/kring?cell={as_int}&k=1")
+    assert r.status_code == 200
+    assert sorted(r.json()["cells"]) == sorted((await client.get(f"/h3/kring?cell={cell}&k=1")).json()["cells"])
+
+async def test_polyfill(client):
     poly = {
         "polygon": {
             "type": "Polygon",
@@ -48,7 +75,76 @@ def test_polyfill():
         },
         "res": 9
     }
-    r = client.post("/h3/polyfill", json=poly)
+    r = await client.post("/h3/polyfill", json=poly)
     assert r.status_code == 200
     data = r.json()
     assert "cells" in data and data["count"] == len(data["cells"])
+
+async def test_polyfill_matches_h3_v4(client):
+    ring = [[-46.64, -23.56], [-46.62, -23.56], [-46.62, -23.54], [-46.64, -23.54], [-46.64, -23.56]]
+    poly = {"polygon": {"type": "Polygon", "coordinates": [ring]}, "res": 9}
+    r = await client.post("/h3/polyfill", json=poly)
+    assert r.status_code == 200
+    expected = h3.polygon_to_cells(h3.geo_to_h3shape({"type": "Polygon", "coordinates": [ring]}), 9)
+    assert sorted(r.json()["cells"]) == sorted(expected)
+
+    # mesma consulta servida do cache continua devolvendo o mesmo conjunto
+    assert sorted((await client.post("/h3/polyfill", json=poly)).json()["cells"]) == sorted(expected)
+
+async def test_polyfill_modes(client):
+    ring = [[-46.64, -23.56], [-46.62, -23.56], [-46.62, -23.54], [-46.64, -23.54], [-46.64, -23.56]]
+    poly = {"polygon": {"type": "Polygon", "coordinates": [ring]}, "res": 9}
+    counts = {}
+    for mode in ("contains", "centroid", "intersects", "covers"):
+        r = await client.post(f"/h3/polyfill?mode={mode}", json=poly)
+        assert r.status_code == 200
+        counts[mode] = r.json()["count"]
+    # containment mais frouxo nunca devolve menos células
+    assert counts["contains"] <= counts["centroid"] <= counts["intersects"] <= counts["covers"]
+
+    assert (await client.post("/h3/polyfill?mode=bogus", json=poly)).status_code == 422
+
+# anel côncavo ("C") p/ os caminhos de fallback do polyfill, que o h3 >= 4.1 nunca usa
+CONCAVE_RING = [[-46.66, -23.58], [-46.60, -23.58], [-46.60, -23.57], [-46.645, -23.57],
+                [-46.645, -23.53], [-46.60, -23.53], [-46.60, -23.52], [-46.66, -23.52],
+                [-46.66, -23.58]]
+
+def _v4_cells(ring, res, contain=None):
+    shape = h3.geo_to_h3shape({"type": "Polygon", "coordinates": [ring]})
+    if contain is None:
+        return set(h3.polygon_to_cells(shape, res))
+    return set(h3.polygon_to_cells_experimental(shape, res, contain=contain))
+
+def test_sample_polyfill_cover_matches_h3_v4():
+    # cobertura grossa + PNP nos centróides = mesma semântica do polygon_to_cells
+    cells = svc._sample_polyfill(np.array(CONCAVE_RING), 9)
+    assert len(cells) == len(set(cells))
+    assert set(cells) == _v4_cells(CONCAVE_RING, 9)
+
+def test_sample_polyfill_grid_path(monkeypatch):
+    monkeypatch.setattr(svc, "_cover_polyfill", lambda *a, **k: None)
+    cells = set(svc._sample_polyfill(np.array(CONCAVE_RING), 9))
+    # pontos da grade estão dentro do polígono: toda célula gerada o toca
+    assert cells and cells <= _v4_cells(CONCAVE_RING, 9, contain="overlap")
+    # o vão do "C" fica de fora
+    assert svc._latlng_to_cell(-23.55, -46.61, 9) not in cells
+
+def test_pnpoly_mask_matches_shapely():
+    shapely = pytest.importorskip("shapely")
+    ring = np.array(CONCAVE_RING[:-1])
+    rx, ry = np.ascontiguousarray(ring[:, 0]), np.ascontiguousarray(ring[:, 1])
+    rng = np.random.default_rng(0)
+    px = rng.uniform(-46.67, -46.59, 50_000)
+    py = rng.uniform(-23.59, -23.51, 50_000)
+    got = svc._pnpoly_mask(px, py, *svc._edge_index(rx, ry))
+    assert np.array_equal(got, shapely.contains_xy(shapely.Polygon(ring), px, py))
+
+async def test_polyfill_endpoint_fallback(client, monkeypatch):
+    def _boom(*args, **kwargs):
+        raise RuntimeError("sem experimental")
+    monkeypatch.setattr(svc, "_POLYGON_TO_CELLS_EXP", _boom)
+    monkeypatch.setattr(svc, "_polyfill_cache", OrderedDict())  # não reaproveita resultado nativo
+    monkeypatch.setattr(svc, "_polyfill_cache_cells", 0)  # contador acompanha o cache trocado
+    r = await client.post("/h3/polyfill", json={"polygon": {"type": "Polygon", "coordinates": [CONCAVE_RING]}, "res": 9})
+    assert r.status_code == 200
+    assert set(r.json()["cells"]) == _v4_cells(CONCAVE_RING, 9)
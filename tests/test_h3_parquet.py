@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+import h3
+
+from h3_parquet import PARTITION_FIELD, cell_parent_u64, resolve_partition_res, write_h3_parquet
+
+def _cells(n=200, res=9, seed=0):
+    rng = np.random.default_rng(seed)
+    lat, lng = rng.uniform(-60, 60, n), rng.uniform(-179, 179, n)
+    return np.array([h3.str_to_int(h3.latlng_to_cell(a, b, res)) for a, b in zip(lat, lng)], dtype=np.uint64)
+
+def test_cell_parent_u64_matches_h3():
+    cells = _cells(res=11)
+    for res in (0, 3, 5, 10, 11):
+        expected = [h3.str_to_int(h3.cell_to_parent(h3.int_to_str(c), res)) for c in cells.tolist()]
+        assert cell_parent_u64(cells, res).tolist() == expected
+
+def _read(path):
+    return ds.dataset(str(path), format="parquet", partitioning="hive").to_table().to_pandas()
+
+def test_write_h3_parquet_replaces_previous_output(tmp_path):
+    out = tmp_path / "vector_h3.parquet"
+    big = _cells()
+    write_h3_parquet(pd.DataFrame({"cell_h3": big}), big, str(out), 5)
+    assert len(_read(out)) == big.size
+
+    # nova rodada com 1 célula: nenhuma partição h3_parent da anterior sobra
+    one = _cells(n=1, seed=1)
+    write_h3_parquet(pd.DataFrame({"cell_h3": one}), one, str(out), 5)
+    assert _read(out)["cell_h3"].astype("uint64").tolist() == one.tolist()
+
+    # e troca de modo nos dois sentidos
+    write_h3_parquet(pd.DataFrame({"cell_h3": big}), big, str(out), 0)
+    assert out.is_file() and len(pd.read_parquet(out)) == big.size
+    write_h3_parquet(pd.DataFrame({"cell_h3": one}), one, str(out), 5)
+    assert out.is_dir() and len(_read(out)) == 1
+
+def test_write_h3_parquet_keeps_foreign_directory(tmp_path):
+    (tmp_path / "notes.txt").write_text("x")
+    cells = _cells(n=3)
+    with pytest.raises(SystemExit):
+        write_h3_parquet(pd.DataFrame({"cell_h3": cells}), cells, str(tmp_path), 5)
+    assert (tmp_path / "notes.txt").exists()
+    assert not any(p.name.startswith(PARTITION_FIELD) for p in tmp_path.iterdir())
+
+def test_write_h3_parquet_many_partitions(tmp_path):
+    # > 1024 pais (o max_partitions padrão do pyarrow), fora de ordem de propósito
+    cells = _cells(n=3000, seed=2)
+    parents = np.unique(cell_parent_u64(cells, 5))
+    assert parents.size > 1024
+    out = tmp_path / "raster_h3.parquet"
+    write_h3_parquet(pd.DataFrame({"cell_h3": cells, "v": np.arange(cells.size)}), cells, str(out), 5)
+    got = _read(out)
+    assert sorted(got["cell_h3"].astype("uint64").tolist()) == sorted(cells.tolist())
+    assert len(list(out.iterdir())) == parents.size
+    # cada linha no diretório do próprio pai
+    assert (cell_parent_u64(got["cell_h3"].astype("uint64"), 5) == got[PARTITION_FIELD].astype("uint64")).all()
+
+def test_resolve_partition_res():
+    assert resolve_partition_res(None, 9) == 5
+    assert resolve_partition_res(None, 3) == 3  # res grossa: não quebra mais a ingestão
+    assert resolve_partition_res(0, 3) == 0
+    with pytest.raises(SystemExit):
+        resolve_partition_res(5, 3)
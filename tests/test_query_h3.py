@@ -0,0 +1,99 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import h3
+
+import query_h3
+from h3_parquet import write_h3_parquet
+from query_h3 import agg_stats, load_table
+
+def _groupby(keys, vals):
+    df = pd.DataFrame({keys.name: keys, "v": vals})
+    return df.groupby(keys.name, observed=True)["v"].agg(["count", "mean", "min", "max"]).reset_index()
+
+@pytest.mark.parametrize("keys", [
+    pd.Series(["b", "a", None, "c", "a", "b", "d", "c"], name="k"),
+    pd.Series(pd.Categorical(["b", "a", None, "c", "a", "b", "d", "c"], categories=list("abcdez")), name="k"),
+    pd.Series([3, 1, 1, 2, 3, 3, 2, 1], name="k"),
+])
+def test_agg_stats_matches_groupby(keys):
+    # "c" e "d" (ou 2) só com NaN: ficam com count=0, como no groupby
+    vals = np.array([1.0, 2.0, 3.0, np.nan, np.nan, 5.0, np.nan, np.nan])
+    if keys.dtype.kind == "i":
+        vals = np.array([1.0, 2.0, 3.0, np.nan, 4.0, 5.0, np.nan, 6.0])
+    got, expected = agg_stats(keys, vals), _groupby(keys, vals)
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False, check_categorical=False)
+
+def test_agg_stats_all_null_keys():
+    keys = pd.Series([None, None], name="k", dtype=object)
+    assert agg_stats(keys, np.array([1.0, 2.0])).empty
+
+def _cells(n, res=9, seed=0):
+    rng = np.random.default_rng(seed)
+    lat, lng = rng.uniform(-23.7, -23.4, n), rng.uniform(-46.8, -46.4, n)
+    return np.unique([h3.str_to_int(h3.latlng_to_cell(a, b, res)) for a, b in zip(lat, lng)]).astype(np.uint64)
+
+@pytest.fixture
+def inputs(tmp_path):
+    """Vetor (células repetidas entre feições) e raster (1 linha por célula) particionados."""
+    cells = _cells(300)
+    rng = np.random.default_rng(1)
+    ndvi = rng.uniform(-0.2, 0.9, cells.size)
+    ndvi[::7] = np.nan
+    raster = pd.DataFrame({"cell_h3": cells, "ndvi_mean": ndvi})
+    vcells = np.sort(np.concatenate([cells[:200], cells[50:120]]))
+    vector = pd.DataFrame({
+        "cell_h3": vcells,
+        "id": np.arange(vcells.size),
+        "tipo": np.where(np.arange(vcells.size) % 3 == 0, "a", "b"),
+    })
+    # "c" só em células de NDVI NaN: grupo com count=0 nos dois engines
+    vector.loc[np.isin(vcells, cells[::7]), "tipo"] = "c"
+    vpath, rpath = str(tmp_path / "vector_h3.parquet"), str(tmp_path / "raster_h3.parquet")
+    write_h3_parquet(vector, vcells, vpath, 5)
+    write_h3_parquet(raster, cells, rpath, 5)
+    return vpath, rpath, vector, raster
+
+def test_load_table_pushdown(inputs):
+    vpath, _, vector, _ = inputs
+    want = np.sort(vector["cell_h3"].to_numpy()[::25])
+    tbl = load_table(vpath, ["cell_h3"], None, cells=want)
+    assert tbl.schema.field("cell_h3").type == "uint64"
+    got = tbl.to_pandas()
+    expected = vector[vector["cell_h3"].isin(want)]
+    assert sorted(got["cell_h3"].tolist()) == sorted(expected["cell_h3"].tolist())
+    assert sorted(got["id"].tolist()) == sorted(expected["id"].tolist())
+
+def test_load_table_legacy_str_ids(tmp_path, inputs):
+    _, _, vector, _ = inputs
+    path = str(tmp_path / "legacy.parquet")
+    vector.assign(cell_h3=[h3.int_to_str(c) for c in vector["cell_h3"].tolist()]).to_parquet(path, index=False)
+    want = vector["cell_h3"].to_numpy()[:5]
+    got = load_table(path, ["cell_h3"], cells=want).to_pandas()
+    assert got["cell_h3"].dtype == np.uint64
+    assert set(got["cell_h3"].tolist()) == set(want.tolist())
+
+def _run(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["query_h3.py", *argv])
+    query_h3.main()
+
+@pytest.mark.parametrize("engine", ["arrow", "polars"])
+def test_query_engines(monkeypatch, tmp_path, inputs, engine):
+    if engine == "polars":
+        pytest.importorskip("polars")
+    vpath, rpath, vector, raster = inputs
+    out = str(tmp_path / f"joined_{engine}.parquet")
+    _run(monkeypatch, "--vector", vpath, "--raster", rpath, "--out", out, "--agg-by", "tipo", "--engine", engine)
+
+    joined = vector.merge(raster, on="cell_h3")
+    # 1 linha por célula, todas as colunas do vetor, ordenada por célula
+    got = pd.read_parquet(out)
+    assert list(got.columns) == ["cell_h3", "id", "tipo", "ndvi_mean"]
+    first = joined.sort_values(["cell_h3", "id"]).drop_duplicates("cell_h3").reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, first, check_dtype=False)
+
+    agg = pd.read_parquet(str(tmp_path / f"joined_{engine}.agg_by_tipo.parquet"))
+    assert agg.loc[agg["tipo"] == "c", "count"].tolist() == [0]
+    pd.testing.assert_frame_equal(agg, _groupby(joined["tipo"], joined["ndvi_mean"].to_numpy()), check_dtype=False)